@@ -11,7 +11,8 @@ setuptools.setup(
     license='Apache License 2.0',
     packages=['urlfile'],
     install_requires=[
-        'cachetools',
         'requests',
+        'urllib3>=1.26',
         'rich'
-    ])
\ No newline at end of file
+    ],
+    extras_require={'http2': ['httpx[http2]']})
\ No newline at end of file
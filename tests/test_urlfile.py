@@ -0,0 +1,233 @@
+import http.server
+import random
+import re
+import threading
+import unittest
+
+import requests
+
+import urlfile
+
+_CHUNK_SIZE = 4096
+_DATA = random.Random(0).randbytes(20 * _CHUNK_SIZE + 123)
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+  '''Serves files from `files` with range support.
+
+  Partial responses are cut to at most `max_body` bytes, extended to the end
+  of the file if `oversized` and fail if they start at one of `fail_starts`.
+  '''
+
+  protocol_version = 'HTTP/1.1'
+  # Headers and body are written separately, avoid delayed acks.
+  disable_nagle_algorithm = True
+  files = {}
+  max_body = None
+  oversized = False
+  fail_starts = ()
+
+  def log_message(self, *args):
+    pass
+
+  def do_GET(self):
+    data = self.files[self.path]
+    match = re.fullmatch(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+    if match is None:
+      self._respond(200, data, {})
+      return
+    start, end = int(match[1]), min(int(match[2]), len(data) - 1)
+    if start >= len(data):
+      self._respond(416, b'', {'Content-Range': f'bytes */{len(data)}'})
+      return
+    if start in self.fail_starts:
+      self._respond(500, b'', {})
+      return
+    if self.oversized:
+      end = len(data) - 1
+    if self.max_body is not None:
+      end = min(end, start + self.max_body - 1)
+    self._respond(206, data[start:end + 1],
+                  {'Content-Range': f'bytes {start}-{end}/{len(data)}'})
+
+  def _respond(self, status, body, headers):
+    self.send_response(status)
+    for key, value in headers.items():
+      self.send_header(key, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+class _ServerTestCase(unittest.TestCase):
+  handler_options = {}
+
+  def setUp(self):
+    handler = type('Handler', (_RangeHandler,), {
+        'files': {
+            '/data': _DATA,
+            '/empty': b'',
+            '/one': b'x'
+        },
+        **self.handler_options
+    })
+    self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def url(self, path: str = '/data') -> str:
+    return f'http://127.0.0.1:{self.server.server_port}{path}'
+
+  def open_files(self, path: str = '/data', **kwargs):
+    '''Opens an unbuffered file, and buffered ones with and without a
+    power-of-two chunk size and with a cache smaller than the thread pool.'''
+    files = [
+        urlfile.UrlFile(url=self.url(path), chunk_size_bytes=_CHUNK_SIZE),
+        urlfile.BufferedUrlFile(url=self.url(path),
+                                chunk_size_bytes=_CHUNK_SIZE,
+                                cache_size_bytes=4 * _CHUNK_SIZE,
+                                **kwargs),
+        urlfile.BufferedUrlFile(url=self.url(path),
+                                chunk_size_bytes=_CHUNK_SIZE + 100,
+                                cache_size_bytes=4 * _CHUNK_SIZE,
+                                **kwargs),
+        urlfile.BufferedUrlFile(url=self.url(path),
+                                chunk_size_bytes=_CHUNK_SIZE,
+                                cache_size_bytes=_CHUNK_SIZE,
+                                max_workers=8,
+                                coalesce_bytes=0,
+                                **kwargs),
+    ]
+    for f in files:
+      self.addCleanup(f.close)
+    return files
+
+
+class ReadTest(_ServerTestCase):
+
+  def test_random_reads(self):
+    rng = random.Random(1)
+    for f in self.open_files():
+      for _ in range(100):
+        start = rng.randrange(len(_DATA))
+        size = rng.randrange(4 * _CHUNK_SIZE)
+        f.seek(start)
+        self.assertEqual(f.read(size), _DATA[start:start + size])
+        self.assertEqual(f.tell(), min(start + size, len(_DATA)))
+
+  def test_random_readinto(self):
+    rng = random.Random(2)
+    for f in self.open_files():
+      for _ in range(100):
+        start = rng.randrange(len(_DATA))
+        buffer = bytearray(rng.randrange(1, 4 * _CHUNK_SIZE))
+        f.seek(start)
+        size = f.readinto(buffer)
+        self.assertEqual(bytes(buffer[:size]), _DATA[start:start + len(buffer)])
+
+  def test_read_all(self):
+    for f in self.open_files():
+      self.assertEqual(f.read(), _DATA)
+      self.assertEqual(f.read(), b'')
+
+  def test_gaps_with_fewer_slots_than_fetches(self):
+    for f in self.open_files():
+      # Cache every other chunk, so that reading everything fetches the gaps
+      # concurrently.
+      for start in range(0, len(_DATA), 2 * _CHUNK_SIZE):
+        f.seek(start)
+        f.read(1)
+      f.seek(0)
+      self.assertEqual(f.read(), _DATA)
+
+  def test_empty_file(self):
+    for f in self.open_files(path='/empty'):
+      self.assertEqual(f.length, 0)
+      self.assertEqual(f.read(), b'')
+      self.assertEqual(f.readinto(bytearray(10)), 0)
+
+  def test_one_byte_file(self):
+    for f in self.open_files(path='/one'):
+      self.assertEqual(f.length, 1)
+      self.assertEqual(f.read(10), b'x')
+      self.assertEqual(f.read(10), b'')
+
+  def test_sequential_reads_prefetch(self):
+    f = urlfile.BufferedUrlFile(url=self.url(),
+                                chunk_size_bytes=_CHUNK_SIZE,
+                                cache_size_bytes=4 * _CHUNK_SIZE,
+                                prefetch_chunks=2)
+    self.addCleanup(f.close)
+    self.assertEqual(f.read(100), _DATA[:100])
+    with f._lock:
+      self.assertTrue(_CHUNK_SIZE in f._cache or _CHUNK_SIZE in f._inflight)
+    data = bytearray(_DATA[:100])
+    while piece := f.read(1000):
+      data += piece
+    self.assertEqual(data, _DATA)
+    # Every chunk is fetched once, by the read or a prefetch.
+    self.assertEqual(f.num_requests, -(-len(_DATA) // _CHUNK_SIZE))
+
+  def test_closed(self):
+    for f in self.open_files():
+      f.read(10)
+      f.close()
+      self.assertTrue(f.closed)
+      with self.assertRaises(ValueError):
+        f.read(10 * _CHUNK_SIZE)
+      with self.assertRaises(ValueError):
+        f.readinto(bytearray(10))
+
+
+class ShortResponseTest(_ServerTestCase):
+  handler_options = {'max_body': 1000}
+
+  def test_read_returns_received_data(self):
+    for f in self.open_files():
+      f.seek(0)
+      self.assertEqual(f.read(3000), _DATA[:1000])
+      self.assertEqual(f.tell(), 1000)
+      buffer = bytearray(3000)
+      f.seek(0)
+      self.assertEqual(f.readinto(buffer), 1000)
+      self.assertEqual(bytes(buffer[:1000]), _DATA[:1000])
+
+  def test_unreachable_data_raises(self):
+    # Buffered fetches start at the chunk boundary and never get this far.
+    for f in self.open_files()[1:]:
+      f.seek(2000)
+      with self.assertRaises(OSError):
+        f.read(10)
+
+
+class OversizedResponseTest(_ServerTestCase):
+  handler_options = {'oversized': True}
+
+  def test_random_reads(self):
+    rng = random.Random(3)
+    for f in self.open_files():
+      for _ in range(20):
+        start = rng.randrange(len(_DATA))
+        size = rng.randrange(4 * _CHUNK_SIZE)
+        f.seek(start)
+        self.assertEqual(f.read(size), _DATA[start:start + size])
+
+
+class FailedPrefetchTest(_ServerTestCase):
+  handler_options = {'fail_starts': (_CHUNK_SIZE,)}
+
+  def test_failed_chunk_raises(self):
+    f = urlfile.BufferedUrlFile(url=self.url(),
+                                chunk_size_bytes=_CHUNK_SIZE,
+                                cache_size_bytes=4 * _CHUNK_SIZE)
+    self.addCleanup(f.close)
+    self.assertEqual(f.read(_CHUNK_SIZE), _DATA[:_CHUNK_SIZE])
+    with self.assertRaises(requests.HTTPError):
+      f.read(_CHUNK_SIZE)
+
+
+if __name__ == '__main__':
+  unittest.main()
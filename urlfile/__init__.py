@@ -1,16 +1,127 @@
-import cachetools
+import collections
+import concurrent.futures
+import contextlib
+import itertools
 import os
 import requests
+import requests.adapters
 import rich.progress
-from typing import Dict
+import threading
+import urllib3.util.request
+import urllib3.util.retry
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+  import httpx
+except ImportError:
+  httpx = None
 
 __all__ = ['BufferedUrlFile', 'UrlFile', 'HTTPRangeRequestUnsupported']
 
+# Byte offsets refer to the unencoded content, so ask the remote not to compress.
+_IDENTITY_ENCODING: Dict[str, str] = {'Accept-Encoding': 'identity'}
+# All encodings that can be decoded (gzip and deflate, plus br and zstd if the
+# brotli and zstandard packages are installed).
+_COMPRESSED_ENCODING: Dict[str, str] = {
+    'Accept-Encoding': urllib3.util.request.ACCEPT_ENCODING
+}
+
 
 class HTTPRangeRequestUnsupported(Exception):
   pass
 
 
+class _LRUCache:
+  '''A minimal least-recently-used cache holding a fixed number of items.'''
+
+  __slots__ = ('_items', '_maxsize')
+
+  def __init__(self, maxsize: int):
+    self._items: collections.OrderedDict = collections.OrderedDict()
+    self._maxsize: int = max(1, maxsize)
+
+  def __setitem__(self, key, value):
+    self._items[key] = value
+    self._items.move_to_end(key)
+    if len(self._items) > self._maxsize:
+      self._items.popitem(last=False)
+
+  def get(self, key, default=None):
+    value = self._items.get(key, default)
+    if value is not default:
+      self._items.move_to_end(key)
+    return value
+
+
+class _SlabCache:
+  '''A least-recently-used cache of chunks backed by a single bytearray slab.
+
+  Chunks are written into fixed-size slots of the slab: a slot is claimed
+  (evicting the least recently used chunk if none is free), filled and then
+  inserted. The slab is allocated on the first claim. Looked up chunks are
+  memoryviews into the slab and only valid until the next claim.
+  '''
+
+  __slots__ = ('_chunk_size', '_num_chunks', '_view', '_free', '_slots')
+
+  def __init__(self, num_chunks: int, chunk_size: int):
+    self._chunk_size: int = chunk_size
+    self._num_chunks: int = max(1, num_chunks)
+    self._view: Optional[memoryview] = None
+    self._free: List[int] = list(range(self._num_chunks))
+    # Key -> (offset into slab, length), in least-recently-used order.
+    self._slots: collections.OrderedDict = collections.OrderedDict()
+
+  def __contains__(self, key) -> bool:
+    return key in self._slots
+
+  def get(self, key, default=None):
+    slot = self._slots.get(key)
+    if slot is None:
+      return default
+    self._slots.move_to_end(key)
+    offset, length = slot
+    return self._view[offset:offset + length]
+
+  def claim(self) -> Optional[int]:
+    '''Takes a slot to fill, returning its offset (None if all are claimed).'''
+    if self._view is None:
+      self._view = memoryview(bytearray(self._num_chunks * self._chunk_size))
+    if self._free:
+      return self._free.pop() * self._chunk_size
+    if self._slots:
+      _, (offset, _) = self._slots.popitem(last=False)
+      return offset
+    return None
+
+  def slot(self, offset: int, length: int) -> memoryview:
+    return self._view[offset:offset + length]
+
+  def insert(self, key, offset: int, length: int):
+    '''Caches the claimed slot at offset, filled with length bytes, as key.'''
+    if key in self._slots:
+      self.release(self._slots.pop(key)[0])
+    self._slots[key] = (offset, length)
+
+  def release(self, offset: int):
+    '''Returns a claimed slot without caching it.'''
+    self._free.append(offset // self._chunk_size)
+
+
+def _default_session(pool_maxsize: int = 10) -> requests.Session:
+  '''Creates a session with a pooled, retrying adapter for http(s).'''
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(
+      pool_connections=1,
+      pool_maxsize=pool_maxsize,
+      max_retries=urllib3.util.retry.Retry(total=3,
+                                           backoff_factor=0.1,
+                                           status_forcelist=(502, 503, 504)))
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+  return session
+
+
 class UrlFile:
   '''A random access file backed by http range requests.'''
 
@@ -18,22 +129,81 @@ class UrlFile:
                url: str,
                session: requests.Session = None,
                chunk_size_bytes: int = 1024 * 1024,
-               verbose: bool = False):
+               verbose: bool = False,
+               *,
+               max_workers: int = 8,
+               http2: bool = False,
+               compress: bool = False):
     self._pos: int = 0
     self._total_bytes_fetched: int = 0
     self._num_requests: int = 0
     self._chunk_size: int = chunk_size_bytes
     self.url: str = url
-    self.session: requests.Session = session or requests.Session()
+    self.session: requests.Session = session or _default_session()
     self.verbose: bool = verbose
-
-    # Make a head request to get length and see whether range requests are even supported.
-    head = self.session.head(url=url)
-    head.raise_for_status()
-    self._length: int = int(head.headers['Content-Length'])
-
-    if 'bytes' not in head.headers.get('Accept-Ranges', 'none'):
-      raise HTTPRangeRequestUnsupported('http range requests not supported.')
+    self._closed: bool = False
+    # Guards bookkeeping (and caches in subclasses) against concurrent fetches.
+    self._lock: threading.Lock = threading.Lock()
+    self._executor: concurrent.futures.ThreadPoolExecutor = (
+        concurrent.futures.ThreadPoolExecutor(max_workers=max_workers))
+
+    # Optionally multiplex concurrent requests over a single http/2 connection.
+    # The session is not used in that case.
+    self._client: Optional['httpx.Client'] = None
+    if http2:
+      if httpx is None:
+        raise ImportError(
+            'http2 requires httpx, install with `pip install urlfile[http2]`.')
+      self._client = httpx.Client(transport=httpx.HTTPTransport(
+          http2=True,
+          retries=3,
+          limits=httpx.Limits(max_keepalive_connections=1,
+                              max_connections=max_workers)))
+
+    # If compress, the whole content is fetched once with compressed transfer
+    # and reads are served from memory, as byte ranges do not apply to
+    # compressed content. If the remote does not compress, range requests are
+    # used as usual.
+    self._compress: bool = compress
+    self._content: Optional[bytes] = None
+
+    # Probe the remote in the background, so that opening does not block.
+    # Errors are raised on first access of the length.
+    self._length: Optional[int] = None
+    self._last_byte: Optional[int] = None
+    self._length_future: concurrent.futures.Future = self._executor.submit(
+        self._probe)
+
+  def _probe(self) -> int:
+    '''Gets the length and checks whether range requests are supported.'''
+    if self._compress:
+      content = self._fetch_compressed()
+      if content is not None:
+        self._content = content
+        return len(content)
+      # The remote does not compress, fall back to range requests.
+
+    # Request the first byte: a partial response confirms range support and
+    # its Content-Range ('bytes 0-0/<length>') contains the length. This saves
+    # a round trip over a separate HEAD request.
+    with self._send(method='GET',
+                    headers={
+                        'Range': 'bytes=0-0',
+                        **_IDENTITY_ENCODING
+                    },
+                    check=False) as response:
+      content_range = response.headers.get('Content-Range', '')
+      # Empty files cannot satisfy any range ('bytes */0').
+      if response.status_code == 416 and content_range == 'bytes */0':
+        self._read_body(response)
+        return 0
+      response.raise_for_status()
+      length = content_range.rsplit('/', 1)[-1]
+      if response.status_code != 206 or not length.isdigit():
+        raise HTTPRangeRequestUnsupported('http range requests not supported.')
+      # Read the probed byte, so the connection is returned to the pool.
+      self._read_body(response)
+      return int(length)
 
   @property
   def total_bytes_fetched(self) -> int:
@@ -45,6 +215,12 @@ class UrlFile:
 
   @property
   def length(self) -> int:
+    if self._length is None:
+      # A probe still pending on close was cancelled.
+      self._check_closed()
+      length = self._length_future.result()
+      self._last_byte = length - 1
+      self._length = length
     return self._length
 
   @property
@@ -66,11 +242,19 @@ class UrlFile:
     return True
 
   def close(self):
-    pass
+    with self._lock:
+      self._closed = True
+    self._executor.shutdown(wait=False, cancel_futures=True)
+    if self._client is not None:
+      self._client.close()
 
   @property
   def closed(self) -> bool:
-    return False
+    return self._closed
+
+  def _check_closed(self):
+    if self._closed:
+      raise ValueError('I/O operation on closed file.')
 
   def seek(self, offset: int, whence: int = os.SEEK_SET):
     if whence == os.SEEK_SET:
@@ -85,11 +269,38 @@ class UrlFile:
     return self._pos
 
   def read(self, size: int = -1) -> bytes:
-    size = size if size > 0 else self.length - self._pos
-    data = self._data(start=self._pos, size=size)
-    self._pos += size
+    self._check_closed()
+    remaining = self.length - self._pos
+    size = min(size, remaining) if size >= 0 else remaining
+    if size <= 0:
+      return b''
+    if self._content is not None:
+      data = self._content[self._pos:self._pos + size]
+    else:
+      data = self._data(start=self._pos, size=size)
+    # The remote may return less than requested, but returning nothing would
+    # look like the end of the file.
+    if not data:
+      raise OSError(f'no data received for range starting at {self._pos}.')
+    self._pos += len(data)
     return data
 
+  def readinto(self, b) -> int:
+    '''Reads into a pre-allocated, writable bytes-like object.'''
+    self._check_closed()
+    view = memoryview(b).cast('B')
+    size = min(len(view), self.length - self._pos)
+    if size <= 0:
+      return 0
+    if self._content is not None:
+      view[:size] = self._content[self._pos:self._pos + size]
+    else:
+      size = self._data_into(start=self._pos, view=view[:size])
+      if size == 0:
+        raise OSError(f'no data received for range starting at {self._pos}.')
+    self._pos += size
+    return size
+
   # Convenience do-nothing methods.
   def __enter__(self) -> 'UrlFile':
     return self
@@ -98,21 +309,23 @@ class UrlFile:
     pass
 
   def _range_request(self, start: int, end: int) -> Dict[str, str]:
-    end = min(self.length - 1, end)
-    self._num_requests += 1
-    self._total_bytes_fetched += (end - start + 1)
-    return {'Range': f'bytes={start}-{end}'}
-
-  def _fetch_data_range(self, start: int, end: int):
-    '''Fetches a data range from the remote.'''
-    response = self.session.get(url=self.url,
-                                headers=self._range_request(start=start,
-                                                            end=end),
-                                stream=True)
-    response.raise_for_status()
-    data_it = response.iter_content(chunk_size=self._chunk_size)
+    last_byte = self._last_byte
+    if end > last_byte:
+      end = last_byte
+    with self._lock:
+      self._num_requests += 1
+      self._total_bytes_fetched += (end - start + 1)
+    return self._range_headers(start=start, end=end)
+
+  def _range_headers(self, start: int, end: int) -> Dict[str, str]:
+    return {'Range': 'bytes=%d-%d' % (start, end), **_IDENTITY_ENCODING}
+
+  @contextlib.contextmanager
+  def _progress(self, total: int) -> Iterator[Callable[[int], None]]:
+    '''Yields a callback to report fetched bytes, shown if verbose.'''
     if not self.verbose:
-      return data_it
+      yield lambda _: None
+      return
 
     # Wrap in verbose feedback indicator.
     with rich.progress.Progress(rich.progress.TextColumn('[bold blue]Fetching',
@@ -126,14 +339,105 @@ class UrlFile:
                                 "•",
                                 rich.progress.TimeRemainingColumn(),
                                 transient=True) as progress:
-      task = progress.add_task("fetch", total=end - start)
-      for chunk in data_it:
-        progress.update(task, advance=len(chunk))
-        yield chunk
+      task = progress.add_task("fetch", total=total)
+      yield lambda size: progress.update(task, advance=size)
+
+  @contextlib.contextmanager
+  def _send(self,
+            method: str,
+            headers: Dict[str, str],
+            check: bool = True) -> Iterator[Any]:
+    '''Sends a streamed request, yielding the response.
+
+    Uses the http/2 client if enabled, the session otherwise. Raises on error
+    statuses if check. Afterwards, any unread rest of the body is drained to
+    release the connection back to the pool, as closing an unread response
+    closes its connection. Callers close responses whose body must not be
+    downloaded.
+    '''
+    if self._client is not None:
+      with self._client.stream(method, self.url, headers=headers) as response:
+        if check:
+          response.raise_for_status()
+        yield response
+        if not response.is_stream_consumed and not response.is_closed:
+          response.read()
+    else:
+      with self.session.request(method, url=self.url, headers=headers,
+                                stream=True) as response:
+        if check:
+          response.raise_for_status()
+        yield response
+        if not response.raw.closed:
+          response.raw.drain_conn()
+
+  def _read_body(self, response: Any) -> bytes:
+    '''Reads the whole (decoded) body of a streamed response.'''
+    if self._client is not None:
+      return response.read()
+    return response.raw.read(decode_content=True)
+
+  def _fetch_whole(self, start: int, end: int) -> bytes:
+    '''Fetches a data range from the remote in one piece.'''
+    if self.verbose:
+      return b''.join(self._fetch_stream(start=start, end=end))
+    with self._send(method='GET',
+                    headers=self._range_request(start=start,
+                                                end=end)) as response:
+      return self._read_body(response)
+
+  def _fetch_compressed(self) -> Optional[bytes]:
+    '''Fetches the whole content, if the remote sends it compressed.'''
+    with self._send(method='GET', headers=_COMPRESSED_ENCODING) as response:
+      if response.headers.get('Content-Encoding',
+                               'identity').lower() in ('', 'identity'):
+        # Close without downloading the uncompressed body.
+        response.close()
+        return None
+      content = self._read_body(response)
+      if self._client is not None:
+        num_bytes = response.num_bytes_downloaded
+      else:
+        num_bytes = response.raw.tell()
+    with self._lock:
+      self._num_requests += 1
+      self._total_bytes_fetched += num_bytes
+    return content
+
+  def _fetch_stream(self, start: int, end: int) -> Iterator[bytes]:
+    '''Fetches a data range from the remote in pieces of up to a chunk.'''
+    with self._send(method='GET',
+                    headers=self._range_request(start=start,
+                                                end=end)) as response:
+      if self._client is not None:
+        data_it = response.iter_bytes(chunk_size=self._chunk_size)
+      else:
+        # Read from the raw stream to skip the iter_content generator.
+        data_it = iter(
+            lambda: response.raw.read(self._chunk_size, decode_content=True),
+            b'')
+      with self._progress(total=end - start + 1) as advance:
+        for data in data_it:
+          advance(len(data))
+          yield data
 
   def _data(self, start: int, size: int) -> bytes:
     '''Gets data for a specific range.'''
-    return b''.join(self._fetch_data_range(start=start, end=start + size - 1))
+    # Ignore anything the remote sends beyond the requested range.
+    return self._fetch_whole(start=start, end=start + size - 1)[:size]
+
+  def _data_into(self, start: int, view: memoryview) -> int:
+    '''Writes data for a specific range into view.
+
+    Returns the number of bytes written, which is less than the size of view
+    if the remote returned less than requested.
+    '''
+    offset = 0
+    for data in self._fetch_stream(start=start, end=start + len(view) - 1):
+      data = data[:len(view) - offset]
+      view[offset:offset + len(data)] = data
+      offset += len(data)
+    return offset
 
 
 class BufferedUrlFile(UrlFile):
@@ -144,49 +448,290 @@ class BufferedUrlFile(UrlFile):
                session: requests.Session = None,
                chunk_size_bytes: int = 1024 * 1024,
                cache_size_bytes: int = 10 * 1024 * 1024,
-               verbose: bool = False):
+               verbose: bool = False,
+               *,
+               max_workers: int = 8,
+               coalesce_bytes: int = None,
+               prefetch_chunks: int = 2,
+               http2: bool = False,
+               compress: bool = False):
     super().__init__(url=url,
-                     session=session,
+                     session=session or
+                     _default_session(pool_maxsize=max_workers),
                      chunk_size_bytes=chunk_size_bytes,
+                     max_workers=max_workers,
+                     http2=http2,
+                     compress=compress,
                      verbose=verbose)
-    self._cache: cachetools.LRUCache = cachetools.LRUCache(
-        maxsize=cache_size_bytes, getsizeof=lambda _: chunk_size_bytes)
-
-  def _fetch_and_cache(self, start: int, end: int) -> bytes:
-    buffer = b''
-    for i, chunk in enumerate(self._fetch_data_range(start=start, end=end)):
-      self._cache[start + i * self._chunk_size] = chunk
-      buffer += chunk
-    return buffer
+    self._cache: _SlabCache = _SlabCache(num_chunks=cache_size_bytes //
+                                         chunk_size_bytes,
+                                         chunk_size=chunk_size_bytes)
+    # Range request headers by (start, end). Chunk aligned ranges repeat, keep
+    # headers for as many as there are chunks.
+    self._headers_cache: _LRUCache = _LRUCache(maxsize=cache_size_bytes //
+                                               chunk_size_bytes)
+    # Chunks are aligned with bit-masks if the chunk size is a power of two.
+    self._chunk_mask: Optional[int] = None
+    self._chunk_mask_inv: Optional[int] = None
+    if chunk_size_bytes & (chunk_size_bytes - 1) == 0:
+      self._chunk_mask = chunk_size_bytes - 1
+      self._chunk_mask_inv = ~self._chunk_mask
+    # Missing ranges separated by at most this many cached bytes are fetched
+    # with a single request, trading some bandwidth for a round trip.
+    self._coalesce_bytes: int = (chunk_size_bytes if coalesce_bytes is None
+                                 else coalesce_bytes)
+    # Number of chunks fetched ahead in the background on sequential reads.
+    # Progress bars cannot be displayed concurrently, so no prefetching if
+    # verbose.
+    self._prefetch_chunks: int = 0 if verbose else prefetch_chunks
+    # Chunk start -> future of prefetches still in flight.
+    self._inflight: Dict[int, concurrent.futures.Future] = {}
+    # End of the previous read, to detect sequential reads.
+    self._last_end: int = 0
+
+  def _range_headers(self, start: int, end: int) -> Dict[str, str]:
+    with self._lock:
+      headers = self._headers_cache.get((start, end))
+      if headers is None:
+        headers = super()._range_headers(start=start, end=end)
+        self._headers_cache[(start, end)] = headers
+    return headers
+
+  def _fetch_and_cache(self,
+                       start: int,
+                       end: int,
+                       view: Optional[memoryview] = None,
+                       view_start: int = 0) -> int:
+    '''Fetches a chunk aligned range straight into cache slots.
+
+    The part overlapping view (which holds the data from view_start on) is
+    copied into it before each chunk is cached, and could be evicted again.
+    Only complete chunks are cached. Returns the number of bytes received.
+    '''
+    end = min(end, self.length - 1)
+    chunk_start = start
+    # Chunk currently being filled, from a claimed slot (or a temporary buffer
+    # if all slots are being filled by other fetches).
+    slot: Optional[int] = None
+    chunk: Optional[memoryview] = None
+    filled = 0
+    try:
+      for data in self._fetch_stream(start=start, end=end):
+        data = memoryview(data)
+        # Ignore anything the remote sends beyond the requested range.
+        while data and chunk_start <= end:
+          if chunk is None:
+            slot, chunk = self._claim(
+                length=min(self._chunk_size, end + 1 - chunk_start))
+            filled = 0
+          size = min(len(data), len(chunk) - filled)
+          chunk[filled:filled + size] = data[:size]
+          filled += size
+          data = data[size:]
+          if filled < len(chunk):
+            continue
+
+          if view is not None:
+            self._copy_into(view, view_start, chunk_start, chunk)
+          if slot is not None:
+            with self._lock:
+              self._cache.insert(chunk_start, slot, len(chunk))
+          chunk_start += len(chunk)
+          slot, chunk = None, None
+
+      # Keep what was received of an incomplete chunk, without caching it.
+      if chunk is not None and view is not None:
+        self._copy_into(view, view_start, chunk_start, chunk[:filled])
+    finally:
+      if slot is not None:
+        with self._lock:
+          self._cache.release(slot)
+    return chunk_start - start + (filled if chunk is not None else 0)
+
+  def _claim(self, length: int) -> Tuple[Optional[int], memoryview]:
+    '''Claims a cache slot for a chunk of length, or a temporary buffer.'''
+    with self._lock:
+      slot = self._cache.claim()
+    if slot is None:
+      return None, memoryview(bytearray(length))
+    return slot, self._cache.slot(slot, length)
+
+  def _coalesce(
+      self, misses: List[Tuple[int, int]],
+      pending: List[Tuple[int, concurrent.futures.Future]]
+  ) -> List[Tuple[int, int]]:
+    '''Merges missing ranges separated by only a few cached bytes.
+
+    The cached chunks covered by a merged range are fetched (and re-cached)
+    again as part of it. Ranges are not merged across chunks that are still
+    being prefetched.
+    '''
+    merged: List[Tuple[int, int]] = []
+    for range_start, range_end in misses:
+      if (merged and
+          range_start - merged[-1][1] - 1 <= self._coalesce_bytes and
+          not any(merged[-1][1] < pending_start < range_start
+                  for pending_start, _ in pending)):
+        merged[-1] = (merged[-1][0], range_end)
+      else:
+        merged.append((range_start, range_end))
+    return merged
+
+  def _prefetch(self, start: int):
+    '''Fetches the chunks following start in the background.'''
+    next_start = self._align(start=start - 1) + self._chunk_size
+    submitted: List[Tuple[int, concurrent.futures.Future]] = []
+    for _ in range(self._prefetch_chunks):
+      if next_start >= self.length:
+        break
+      with self._lock:
+        # No background work once closed, the executor is shut down.
+        if self._closed:
+          break
+        if next_start not in self._cache and next_start not in self._inflight:
+          future = self._executor.submit(self._fetch_and_cache, next_start,
+                                         next_start + self._chunk_size - 1)
+          self._inflight[next_start] = future
+          submitted.append((next_start, future))
+      next_start += self._chunk_size
+
+    # Register callbacks without holding the lock: a callback runs right away
+    # if the prefetch has already finished, and it takes the lock itself.
+    for key, future in submitted:
+      future.add_done_callback(lambda _, key=key: self._prefetch_done(key))
+
+  def _prefetch_done(self, start: int):
+    with self._lock:
+      self._inflight.pop(start, None)
 
   def _align(self, start: int) -> int:
+    if self._chunk_mask_inv is not None:
+      return start & self._chunk_mask_inv
     return start - (start % self._chunk_size)
 
   def _data(self, start: int, size: int) -> bytes:
     '''Gets data for a specific range.'''
-    # Align start to chunk boundary.
+    # Fast path for reads within a single cached chunk.
     chunk_start = self._align(start=start)
-    end = start + size
     offset = start - chunk_start
-
-    buffer = b''
-
-    next_start = chunk_start
-    while next_start < end:
-      # Fill up with everything that is in the cache.
-      if next_start in self._cache:
-        buffer += self._cache[next_start]
-        next_start += self._chunk_size
-        continue
-
-      # Find next start of a chunk that's already in the cache.
-      range_end = next_start + self._chunk_size
-      while range_end < end and range_end not in self._cache:
-        range_end += self._chunk_size
-
-      # Fetch the next blob.
-      buffer += self._fetch_and_cache(start=next_start, end=range_end - 1)
-
-      next_start = range_end
-
-    return buffer[offset:offset + size]
+    with self._lock:
+      chunk = self._cache.get(chunk_start)
+      data = None
+      if chunk is not None and offset + size <= len(chunk):
+        data = chunk[offset:offset + size].tobytes()
+        chunk_end = chunk_start + len(chunk)
+    if data is not None:
+      # Keep prefetching ahead when a sequential read enters or finishes a
+      # chunk.
+      if (self._prefetch_chunks > 0 and start == self._last_end and
+          (offset == 0 or start + size == chunk_end)):
+        self._prefetch(start=start + size)
+      self._last_end = start + size
+      return data
+
+    out = bytearray(max(0, min(size, self.length - start)))
+    size = self._data_into(start=start, view=memoryview(out))
+    if size < len(out):
+      del out[size:]
+    return bytes(out)
+
+  @staticmethod
+  def _copy_into(view: memoryview, start: int, part_start: int, part):
+    '''Copies the part of data starting at part_start that overlaps view.'''
+    lo = max(part_start, start)
+    hi = min(part_start + len(part), start + len(view))
+    if lo < hi:
+      # Slice through a memoryview, slicing a bytearray would copy.
+      view[lo - start:hi - start] = memoryview(part)[lo - part_start:hi -
+                                                     part_start]
+
+  def _data_into(self, start: int, view: memoryview) -> int:
+    '''Writes data for a specific range into view.
+
+    Returns the number of bytes written, which is less than the size of view
+    if the remote returned less than requested.
+    '''
+    # Align start to chunk boundary.
+    chunk_start = self._align(start=start)
+    end = start + len(view)
+
+    # Copy everything that is in the cache (while holding the lock, as cached
+    # chunks may be overwritten afterwards) and collect the chunks being
+    # prefetched. Each chunk is looked up once.
+    chunk_starts = range(chunk_start, end, self._chunk_size)
+    pending: List[Tuple[int, concurrent.futures.Future]] = []
+    missing: List[bool] = []
+
+    with self._lock:
+      for next_start in chunk_starts:
+        chunk = self._cache.get(next_start)
+        if chunk is not None:
+          self._copy_into(view, start, next_start, chunk)
+          missing.append(False)
+          continue
+        future = self._inflight.get(next_start)
+        if future is not None:
+          pending.append((next_start, future))
+        missing.append(future is None)
+
+    # Group runs of missing chunks into ranges.
+    misses: List[Tuple[int, int]] = []
+    index = 0
+    for is_missing, run in itertools.groupby(missing):
+      count = sum(1 for _ in run)
+      if is_missing:
+        misses.append((chunk_starts[index],
+                       chunk_starts[index] + count * self._chunk_size - 1))
+      index += count
+
+    misses = self._coalesce(misses=misses, pending=pending)
+
+    # End of the data received without gaps, lowered by short responses.
+    received_end = end
+
+    def received(part_start: int, part_end: int, count: int):
+      nonlocal received_end
+      if count < min(part_end, self.length - 1) - part_start + 1:
+        received_end = min(received_end, part_start + count)
+
+    # Fetch the missing ranges, concurrently if there is more than one. Progress
+    # bars cannot be displayed concurrently, so verbose fetches stay sequential.
+    if len(misses) == 1 or self.verbose:
+      for range_start, range_end in misses:
+        received(
+            range_start, range_end,
+            self._fetch_and_cache(start=range_start,
+                                  end=range_end,
+                                  view=view,
+                                  view_start=start))
+    else:
+      futures = {
+          self._executor.submit(self._fetch_and_cache, range_start, range_end,
+                                view, start): (range_start, range_end)
+          for range_start, range_end in misses
+      }
+      for future in concurrent.futures.as_completed(futures):
+        received(*futures[future], future.result())
+
+    # Wait for prefetched chunks and copy them from the cache. Fetch them again
+    # if that failed, or they were already evicted or incomplete.
+    for pending_start, future in pending:
+      pending_end = pending_start + self._chunk_size - 1
+      concurrent.futures.wait([future])
+      with self._lock:
+        chunk = self._cache.get(pending_start)
+        if chunk is not None:
+          self._copy_into(view, start, pending_start, chunk)
+          count = len(chunk)
+      if chunk is None:
+        count = self._fetch_and_cache(start=pending_start,
+                                      end=pending_end,
+                                      view=view,
+                                      view_start=start)
+      received(pending_start, pending_end, count)
+
+    size = max(0, received_end - start)
+    if self._prefetch_chunks > 0 and start == self._last_end:
+      self._prefetch(start=start + size)
+    self._last_end = start + size
+    return size